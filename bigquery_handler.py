@@ -1,7 +1,34 @@
+import io
 import logging
 from google.cloud import bigquery
 from google.cloud import storage
+from google.api_core.exceptions import BadRequest, NotFound, PreconditionFailed
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types, writer
+import pyarrow as pa
 import json
+import uuid
+from datetime import datetime, timedelta, timezone
+from utils import coerce_value
+
+# Batches up to this many rows are streamed straight into BigQuery through the
+# Storage Write API instead of being staged as a file in GCS.
+DEFAULT_STREAM_MAX_ROWS = 50000
+
+# Rows per AppendRows request, keeping each request well below the 10 MB limit.
+STREAM_APPEND_ROWS = 500
+
+# Staging tables left behind by a crashed run are dropped by BigQuery after this long.
+STAGING_TABLE_EXPIRATION = timedelta(days=1)
+
+# Arrow types used when streaming typed columns, anything else is sent as a string.
+BIGQUERY_TO_ARROW_TYPES = {
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+    'BOOLEAN': pa.bool_(),
+    'DATE': pa.date32(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC')
+}
 
 class BigQueryHandler:
     def __init__(self, config):
@@ -10,6 +37,8 @@ class BigQueryHandler:
         self.bucket_name = config['bucket_name']  # GCS bucket for temporary file storage
         self.client = bigquery.Client(project=self.project_id)
         self.storage_client = storage.Client()
+        self.write_client = bigquery_storage_v1.BigQueryWriteClient()
+        self.stream_max_rows = config.get('stream_max_rows', DEFAULT_STREAM_MAX_ROWS)
 
     def upload_to_gcs(self, data, gcs_path, chunk_size):
         """Upload newline-delimited JSON data to GCS with error handling and logging."""
@@ -27,7 +56,7 @@ class BigQueryHandler:
                     chunk = data[i:i + chunk_size]
                     # Stream data chunk by chunk
                     for record in chunk:
-                        buffer.write(json.dumps(record) + '\n')  # Write JSON records to the buffer
+                        buffer.write(json.dumps(record, default=str) + '\n')  # Write JSON records to the buffer
 
                     # Flush the buffer into the writable GCS stream
                     f.write(buffer.getvalue())
@@ -70,11 +99,161 @@ class BigQueryHandler:
             logging.error(f"Failed to load data into BigQuery from GCS: {e}")
             raise
 
-    def insert_into_bigquery_in_bathes(self, table_name, data, chunk_size):
-        """Insert data into BigQuery using GCS as staging, with proper logging and error handling."""
+    def _write_pending_stream(self, table_name, data, schema):
+        """Append rows to a pending Storage Write API stream on the table and commit it in one step."""
+        parent = self.write_client.table_path(self.project_id, self.dataset_id, table_name)
+        write_stream = self.write_client.create_write_stream(
+            parent=parent,
+            write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING)
+        )
+        logging.info(f"Opened pending write stream {write_stream.name} for table {table_name}.")
+
+        arrow_schema = pa.schema([
+            pa.field(field.name, BIGQUERY_TO_ARROW_TYPES.get(field.field_type, pa.string())) for field in schema
+        ])
+        request_template = types.AppendRowsRequest()
+        request_template.write_stream = write_stream.name
+        template_rows = types.AppendRowsRequest.ArrowData()
+        template_rows.writer_schema.serialized_schema = arrow_schema.serialize().to_pybytes()
+        request_template.arrow_rows = template_rows
+        append_rows_stream = writer.AppendRowsStream(self.write_client, request_template)
+
+        try:
+            futures = []
+            for offset in range(0, len(data), STREAM_APPEND_ROWS):
+                chunk = data[offset:offset + STREAM_APPEND_ROWS]
+                batch = pa.RecordBatch.from_pylist(chunk, schema=arrow_schema)
+
+                request = types.AppendRowsRequest()
+                request.offset = offset
+                rows = types.AppendRowsRequest.ArrowData()
+                rows.rows.serialized_record_batch = batch.serialize().to_pybytes()
+                request.arrow_rows = rows
+                futures.append(append_rows_stream.send(request))
+
+            # Wait for every append to be acknowledged before finalizing
+            for future in futures:
+                future.result()
+        finally:
+            append_rows_stream.close()
+
+        self.write_client.finalize_write_stream(name=write_stream.name)
+
+        commit_response = self.write_client.batch_commit_write_streams(
+            types.BatchCommitWriteStreamsRequest(parent=parent, write_streams=[write_stream.name])
+        )
+        if commit_response.stream_errors:
+            logging.error(f"Errors occurred while committing write stream: {commit_response.stream_errors}")
+            raise RuntimeError(f"BigQuery write stream commit encountered errors: {commit_response.stream_errors}")
+
+    def _create_staging_table(self, table_name, schema):
+        """Create an empty, uniquely named staging table that expires on its own if it is never dropped."""
+        staging_name = f"{table_name}_staging_{uuid.uuid4().hex[:8]}"
+        staging_table = bigquery.Table(self.client.dataset(self.dataset_id).table(staging_name), schema=schema)
+        staging_table.expires = datetime.now(timezone.utc) + STAGING_TABLE_EXPIRATION
+        self.client.create_table(staging_table)
+        return staging_name
+
+    def _swap_in_staging(self, table_name, staging_name, schema, replace_column=None, replace_values=None):
+        """Replace the target rows with the staged rows in a single transaction."""
+        target = f"`{self.project_id}.{self.dataset_id}.{table_name}`"
+        staging = f"`{self.project_id}.{self.dataset_id}.{staging_name}`"
+        columns = ", ".join(field.name for field in schema)
+
+        job_config = bigquery.QueryJobConfig()
+        condition = "TRUE"
+        if replace_column:
+            condition = f"{replace_column} IN UNNEST(@keys)"
+            job_config.query_parameters = [bigquery.ArrayQueryParameter("keys", "STRING", replace_values)]
+
+        # A failing statement rolls the whole transaction back, leaving the target untouched
+        query = (
+            "BEGIN TRANSACTION;\n"
+            f"DELETE FROM {target} WHERE {condition};\n"
+            f"INSERT INTO {target} ({columns}) SELECT {columns} FROM {staging};\n"
+            "COMMIT TRANSACTION;"
+        )
+        self.client.query(query, job_config=job_config).result()
+
+    def stream_to_bigquery(self, table_name, data, schema, replace_column=None, replace_values=None):
+        """Write rows straight into BigQuery through a pending Storage Write API stream.
+
+        Rows are sent as Arrow record batches to a staging table and committed there
+        in one step. A single transaction then deletes the target rows (all of them,
+        or only those whose ``replace_column`` is in ``replace_values``) and inserts
+        the staged ones, so the target either gets the whole batch or stays as it was.
+        """
+        try:
+            table_ref = self.client.dataset(self.dataset_id).table(table_name)
+            self.client.create_table(bigquery.Table(table_ref, schema=schema), exists_ok=True)
+
+            staging_name = self._create_staging_table(table_name, schema)
+            try:
+                self._write_pending_stream(staging_name, data, schema)
+                self._swap_in_staging(table_name, staging_name, schema, replace_column, replace_values)
+            finally:
+                self.client.delete_table(self.client.dataset(self.dataset_id).table(staging_name), not_found_ok=True)
+
+            logging.info(f"Successfully streamed {len(data)} rows into BigQuery table {table_name}.")
+
+        except Exception as e:
+            logging.error(f"Failed to stream data into BigQuery table {table_name}: {e}")
+            raise
+
+    def _coerce_records(self, data, schema):
+        """Convert processed records to the Python types of their BigQuery columns."""
+        field_types = {field.name: field.field_type for field in schema}
+        return [
+            {key: coerce_value(value, field_types.get(key, "STRING"), key) for key, value in record.items()}
+            for record in data
+        ]
+
+    def get_table_schema(self, table_name):
+        """Return the schema of a table, or None if it does not exist yet."""
         try:
-            # Define schema based on the first record
-            schema = [bigquery.SchemaField(field, "STRING") for field in data[0].keys()]
+            return self.client.get_table(self.client.dataset(self.dataset_id).table(table_name)).schema
+        except NotFound:
+            return None
+
+    def table_schema_matches(self, table_name, schema):
+        """Check whether the table is missing or already has exactly the given columns and types."""
+        table_schema = self.get_table_schema(table_name)
+        if table_schema is None:
+            return True
+        return [(f.name, f.field_type) for f in table_schema] == [(f.name, f.field_type) for f in schema]
+
+    def fetch_max_value(self, table_name, column):
+        """Return the largest value of a column, or None if the table or column does not exist yet."""
+        query = f"SELECT MAX({column}) AS max_value FROM `{self.project_id}.{self.dataset_id}.{table_name}`"
+        try:
+            rows = self.client.query(query).result()
+        except (NotFound, BadRequest):
+            return None
+        return next(iter(rows)).max_value
+
+    def delete_rows(self, table_name, key_column, key_values):
+        """Delete the rows whose (STRING) key column matches one of the given values."""
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("keys", "STRING", key_values)]
+        )
+        query = f"DELETE FROM `{self.project_id}.{self.dataset_id}.{table_name}` WHERE {key_column} IN UNNEST(@keys)"
+        logging.info(f"Deleting rows of {len(key_values)} {key_column} values from table {table_name}.")
+        self.client.query(query, job_config=job_config).result()
+
+    def insert_into_bigquery_in_batches(self, table_name, data, chunk_size, schema=None):
+        """Insert data into BigQuery, streaming small batches directly and staging large ones in GCS."""
+        try:
+            if schema is None:
+                # Define schema based on the first record
+                schema = [bigquery.SchemaField(field, "STRING") for field in data[0].keys()]
+            else:
+                data = self._coerce_records(data, schema)
+
+            # Schema changes go through the load job, which replaces the table schema
+            if len(data) <= self.stream_max_rows and self.table_schema_matches(table_name, schema):
+                logging.info(f"Streaming {len(data)} rows directly into BigQuery for table {table_name}.")
+                self.stream_to_bigquery(table_name, data, schema)
+                return
 
             # Generate a unique path for the temporary file in GCS
             gcs_path = f"temp/{table_name}_data.json"
@@ -91,3 +270,69 @@ class BigQueryHandler:
             logging.error(f"Failed to insert data into BigQuery for table {table_name}: {e}")
             raise
 
+    def replace_rows(self, table_name, key_column, key_values, data, chunk_size, schema):
+        """Replace the rows whose key column matches one of the key values with the given records."""
+        try:
+            if not data:
+                self.delete_rows(table_name, key_column, key_values)
+                return
+
+            data = self._coerce_records(data, schema)
+            if len(data) <= self.stream_max_rows:
+                logging.info(f"Streaming {len(data)} replacement rows directly into BigQuery for table {table_name}.")
+                self.stream_to_bigquery(table_name, data, schema,
+                                        replace_column=key_column, replace_values=key_values)
+                return
+
+            gcs_path = f"temp/{table_name}_data.json"
+            logging.info(f"Starting data upload to GCS for table {table_name}.")
+            self.upload_to_gcs(data, gcs_path, chunk_size)
+
+            # Large replacements are loaded into a staging table and swapped in the same way as streamed ones
+            staging_name = self._create_staging_table(table_name, schema)
+            try:
+                logging.info(f"Starting data load into BigQuery staging table {staging_name}.")
+                self.load_from_gcs_to_bigquery(staging_name, gcs_path, schema)
+                self._swap_in_staging(table_name, staging_name, schema, key_column, key_values)
+            finally:
+                self.client.delete_table(self.client.dataset(self.dataset_id).table(staging_name), not_found_ok=True)
+
+        except Exception as e:
+            logging.error(f"Failed to replace rows in BigQuery table {table_name}: {e}")
+            raise
+
+    def stage_shard(self, gcs_path, data, chunk_size, schema):
+        """Upload one shard of typed records to GCS, to be loaded together with its sibling shards."""
+        self.upload_to_gcs(self._coerce_records(data, schema), gcs_path, chunk_size)
+
+    def write_json_to_gcs(self, gcs_path, payload):
+        """Write a small JSON document (manifest, schema) to GCS."""
+        blob = self.storage_client.bucket(self.bucket_name).blob(gcs_path)
+        blob.upload_from_string(json.dumps(payload), content_type="application/json")
+
+    def read_json_from_gcs(self, gcs_path):
+        """Read a small JSON document from GCS, returning None if it does not exist."""
+        blob = self.storage_client.bucket(self.bucket_name).blob(gcs_path)
+        try:
+            return json.loads(blob.download_as_text())
+        except NotFound:
+            return None
+
+    def count_gcs_files(self, prefix):
+        """Count the files stored under a GCS prefix."""
+        return sum(1 for _ in self.storage_client.list_blobs(self.bucket_name, prefix=prefix))
+
+    def delete_gcs_prefix(self, prefix):
+        """Delete every file stored under a GCS prefix."""
+        blobs = list(self.storage_client.list_blobs(self.bucket_name, prefix=prefix))
+        self.storage_client.bucket(self.bucket_name).delete_blobs(blobs)
+        logging.info(f"Deleted {len(blobs)} files under {prefix} in GCS bucket {self.bucket_name}.")
+
+    def create_gcs_marker(self, gcs_path):
+        """Create an empty marker file, returning False if it already exists."""
+        blob = self.storage_client.bucket(self.bucket_name).blob(gcs_path)
+        try:
+            blob.upload_from_string("", if_generation_match=0)
+            return True
+        except PreconditionFailed:
+            return False
@@ -1,86 +1,298 @@
 import logging
 import json
+import uuid
+from datetime import datetime
+from google.cloud import bigquery
 from odoo_api import OdooAPI
 from bigquery_handler import BigQueryHandler
-from utils import load_config
+from utils import load_config, decode_work_item, coerce_value
+from work_queue import PubSubQueue, InProcessQueue
 
 logging.basicConfig(level=logging.INFO)
 
-def main(cloud_event, abc):
-    # Load configuration
-    config = load_config()
+# Number of records per work item when the run is fanned out across instances.
+DEFAULT_SHARD_SIZE = 5000
 
-    # Initialize OdooAPI and BigQueryHandler
-    odoo_api = OdooAPI(config['odoo'])
-    bigquery_handler = BigQueryHandler(config['bigquery'])
+# BigQuery table, Odoo model, OdooAPI fetch method and GCS upload chunk size of every dataset.
+TABLES = [
+    ('sales_orders', 'sale.order', 'fetch_sales_orders', 1),
+    ('sales_order_line', 'sale.order.line', 'fetch_sales_order_line', 1),
+    ('purchase_orders', 'purchase.order', 'fetch_purchase_orders', 1),
+    ('purchase_order_line', 'purchase.order.line', 'fetch_purchase_order_line', 1),
+    ('accounts', 'account.move', 'fetch_accounts', 200),
+    ('account_move_lines', 'account.move.line', 'fetch_account_move_lines', 200),
+    ('stock_inventory', 'stock.picking', 'fetch_stock_inventory', 1),
+    ('contacts', 'res.partner', 'fetch_contacts', 1),
+    ('manufacturing', 'mrp.production', 'fetch_manufacturing', 1)
+]
+TABLES_BY_NAME = {table[0]: table for table in TABLES}
 
-    ##### Fetch Sales Orders from Odoo #####
-    sales_orders = odoo_api.fetch_sales_orders()
-    if sales_orders:
-        # Insert Sales Orders into BigQuery
-        bigquery_handler.insert_into_bigquery_in_batches('sales_orders', sales_orders, 1)
-    else:
-        logging.info("No sales orders fetched.")
+# Keys every item of a fanned-out run has to carry, by mode.
+REQUIRED_WORK_ITEM_KEYS = {
+    'work': ('run_id', 'table', 'shard', 'start_id', 'end_id'),
+    'coordinate': ('run_id',)
+}
 
-    ##### Sales Orders Lines #####
-    sales_order_line = odoo_api.fetch_sales_order_line()
-    if sales_order_line:
-        # Insert Sales Order Lines into BigQuery
-        bigquery_handler.insert_into_bigquery_in_batches('sales_order_line', sales_order_line, 1)
-    else:
-        logging.info("No sales order line fetched.")
+# Header table -> (line table, field on the lines pointing at the header). Only the
+# lines of headers changed since the previous run are fetched and replaced.
+LINE_TABLES = {
+    'sales_orders': ('sales_order_line', 'order_id'),
+    'purchase_orders': ('purchase_order_line', 'order_id'),
+    'accounts': ('account_move_lines', 'move_id')
+}
 
-    ##### Fetch Purchase Orders from Odoo #####
-    purchase_orders = odoo_api.fetch_purchase_orders()
-    if purchase_orders:
-        # Insert Purchase Orders into BigQuery
-        bigquery_handler.insert_into_bigquery_in_batches('purchase_orders', purchase_orders, 1)
-    else:
-        logging.info("No purchase orders fetched.")
+def _derive_schema(odoo_api, bigquery_handler, table_name, model, records):
+    """Derive the schema of processed records, falling back to the existing table's column types."""
+    return odoo_api.metadata.bigquery_schema(model, records, bigquery_handler.get_table_schema(table_name))
 
-    ##### Fetch Purchase Oders Lines #####
-    purchase_order_line = odoo_api.fetch_purchase_order_line()
-    if purchase_order_line:
-        # Insert Purchase Order Lines into BigQuery
-        bigquery_handler.insert_into_bigquery_in_batches('purchase_order_line', purchase_order_line, 1)
-    else:
-        logging.info("No purchase order line fetched.")
+def load_table(odoo_api, bigquery_handler, table_name, records=None):
+    """Load a table into BigQuery, fetching every record from Odoo unless they are given."""
+    _, model, fetch_method, chunk_size = TABLES_BY_NAME[table_name]
+    if records is None:
+        records = getattr(odoo_api, fetch_method)()
 
-    ##### Fetch Accounts #####
-    accounts = odoo_api.fetch_accounts()
-    if accounts:
-        # Insert Accounts into BigQuery
-        bigquery_handler.insert_into_bigquery_in_batches('accounts', accounts, 200)
+    if records:
+        schema = _derive_schema(odoo_api, bigquery_handler, table_name, model, records)
+        bigquery_handler.insert_into_bigquery_in_batches(table_name, records, chunk_size, schema)
     else:
-        logging.info("No account fetched.")
+        logging.info(f"No {table_name} fetched.")
 
-    ##### Fetch Account Move Lines from Odoo #####
+def _changed_parent_ids(parents, watermark):
+    """Ids of the parents written at or after the watermark."""
+    if isinstance(watermark, str):
+        watermark = coerce_value(watermark, 'TIMESTAMP')
 
-    account_move_lines = odoo_api.fetch_account_move_lines()
-    if account_move_lines:
-        # Insert Account Move Lines into BigQuery
-        bigquery_handler.insert_into_bigquery_in_batches('account_move_lines', processed_records, 200)
-    else:
-        logging.info("No account move lines fetched.")
+    changed_ids = []
+    for parent in parents:
+        write_date = coerce_value(parent['write_date'], 'TIMESTAMP')
+        if write_date is not None and write_date >= watermark:
+            changed_ids.append(int(parent['id']))
+    return changed_ids
 
-    ##### Fetch Stock Inventory #####
-    stock_inventory = odoo_api.fetch_stock_inventory()
-    if stock_inventory:
-        # Insert Stock Inventory into BigQuery
-        bigquery_handler.insert_into_bigquery_in_batches('stock_inventory', stock_inventory, 1)
-    else:
-        logging.info("No stock inventory fetched.")
+def load_table_with_lines(odoo_api, bigquery_handler, table_name, incremental_lines=True):
+    """Load a header table and replace only the lines of the headers changed since the previous run.
 
-    ##### Fetch Contacts #####
-    contacts = odoo_api.fetch_contacts()
-    if contacts:
-        bigquery_handler.insert_into_bigquery_in_batches('contacts', contacts, 1)
-    else:
-        logging.info("No contacts fetched.")
+    With ``incremental_lines`` off every line is reloaded, which also picks up line
+    changes that did not touch the header and lines of deleted headers.
+    """
+    line_table, parent_field = LINE_TABLES[table_name]
+    _, model, fetch_method, _ = TABLES_BY_NAME[table_name]
+    _, line_model, line_fetch_method, line_chunk_size = TABLES_BY_NAME[line_table]
+    key_column = f"{parent_field}_id"
+
+    # Read before the header table is overwritten, it marks what the previous run already loaded
+    watermark = bigquery_handler.fetch_max_value(table_name, 'write_date')
+    parents = getattr(odoo_api, fetch_method)()
+
+    line_schema = bigquery_handler.get_table_schema(line_table)
+    incremental = (
+        incremental_lines and watermark is not None and bool(parents)
+        and line_schema is not None and key_column in [field.name for field in line_schema]
+    )
+
+    if incremental:
+        changed_ids = _changed_parent_ids(parents, watermark)
+        lines = odoo_api.fetch_lines_for_parents(line_fetch_method, parent_field, changed_ids)
+        schema = odoo_api.metadata.bigquery_schema(line_model, lines, line_schema) if lines else None
+
+        # Column types changed since the last load, the whole line table has to be reloaded
+        if schema is not None and not bigquery_handler.table_schema_matches(line_table, schema):
+            logging.info(f"Schema of {line_table} changed, reloading every line.")
+            incremental = False
+        elif changed_ids:
+            bigquery_handler.replace_rows(
+                line_table, key_column, [str(parent_id) for parent_id in changed_ids], lines, line_chunk_size, schema
+            )
+            logging.info(f"Replaced lines of {len(changed_ids)} changed {table_name} in {line_table}.")
+        else:
+            logging.info(f"No {table_name} changed since {watermark}, {line_table} is up to date.")
+
+    if not incremental:
+        load_table(odoo_api, bigquery_handler, line_table)
+
+    # Headers are loaded last, a failed line fetch has raised by now so the next run
+    # retries the refresh from the same watermark
+    load_table(odoo_api, bigquery_handler, table_name, parents)
+
+def run_all(odoo_api, bigquery_handler, incremental_lines=True):
+    """Extract every table from Odoo and load it into BigQuery within this instance."""
+    # One metadata request for every model instead of one per table
+    odoo_api.metadata.load([model for _, model, _, _ in TABLES])
+
+    line_tables = {line_table for line_table, _ in LINE_TABLES.values()}
+    for table_name, _, _, _ in TABLES:
+        if table_name in LINE_TABLES:
+            load_table_with_lines(odoo_api, bigquery_handler, table_name, incremental_lines)
+        elif table_name not in line_tables:
+            load_table(odoo_api, bigquery_handler, table_name)
+
+def _run_prefix(run_id):
+    """GCS prefix holding the manifest, schemas and staged shards of a fanned-out run."""
+    return f"temp/runs/{run_id}"
+
+def dispatch(odoo_api, bigquery_handler, queue, shard_size):
+    """Split the run into one work item per table and id-range shard and publish them."""
+    run_id = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+    prefix = _run_prefix(run_id)
+
+    manifest = {}
+    work_items = []
+    for table_name, model, _, _ in TABLES:
+        ids = odoo_api.fetch_ids(model)
+        starts = range(0, len(ids), shard_size)
+        for shard, start in enumerate(starts):
+            end = start + shard_size
+            work_items.append({
+                'mode': 'work',
+                'run_id': run_id,
+                'table': table_name,
+                'shard': shard,
+                'start_id': ids[start],
+                # The last shard stays open so records created after dispatch are not missed
+                'end_id': ids[end - 1] if end < len(ids) else None
+            })
+        manifest[table_name] = len(starts)
+
+    if not work_items:
+        logging.info("No records fetched for any table, nothing to dispatch.")
+        return
+
+    # The manifest is written first so workers can tell when every shard has reported
+    bigquery_handler.write_json_to_gcs(f"{prefix}/manifest.json", manifest)
+    for work_item in work_items:
+        queue.publish(work_item)
+    queue.flush()
+    logging.info(f"Dispatched run {run_id} as {len(work_items)} work items: {json.dumps(manifest)}")
+
+def process_work_item(work_item, odoo_api, bigquery_handler, queue):
+    """Extract one id-range shard of a table into GCS and trigger the coordinator after the last shard."""
+    table_name, model, fetch_method, chunk_size = TABLES_BY_NAME[work_item['table']]
+    run_id = work_item['run_id']
+    prefix = _run_prefix(run_id)
+
+    domain = [['id', '>=', work_item['start_id']]]
+    if work_item['end_id'] is not None:
+        domain.append(['id', '<=', work_item['end_id']])
+    # A failed request raises so Pub/Sub redelivers the work item instead of staging an empty shard
+    fetched = getattr(odoo_api, fetch_method)(domain=domain, raise_errors=True)
 
-    ##### Fetch Manufacturing #####
-    mnf = odoo_api.fetch_manufacturing()
-    if mnf:
-        bigquery_handler.insert_into_bigquery_in_batches('manufacturing', mnf, 1)
+    # Filtered again here so an endpoint that ignores the domain cannot stage a row in several shards
+    records = [
+        record for record in fetched
+        if work_item['start_id'] <= int(record['id'])
+        and (work_item['end_id'] is None or int(record['id']) <= work_item['end_id'])
+    ]
+    if len(records) < len(fetched):
+        logging.warning(f"Dropped {len(fetched) - len(records)} {table_name} records outside the id range "
+                        f"of shard {work_item['shard']}.")
+
+    schema = []
+    if records:
+        schema = _derive_schema(odoo_api, bigquery_handler, table_name, model, records)
+        bigquery_handler.write_json_to_gcs(f"{prefix}/schemas/{table_name}.json", [field.to_api_repr() for field in schema])
+
+    # Genuinely empty ranges are staged too, every shard file counts as a report to the coordinator
+    bigquery_handler.stage_shard(f"{prefix}/shards/{table_name}/{work_item['shard']:05d}.json", records, chunk_size, schema)
+    logging.info(f"Staged shard {work_item['shard']} of {table_name} with {len(records)} records for run {run_id}.")
+
+    manifest = bigquery_handler.read_json_from_gcs(f"{prefix}/manifest.json")
+    if manifest is None:
+        logging.error(f"Run {run_id} has no manifest, staged shard {work_item['shard']} of {table_name} "
+                      f"without triggering the coordinator.")
+        return
+    reported = bigquery_handler.count_gcs_files(f"{prefix}/shards/")
+    # The marker makes sure only one worker triggers the coordinator
+    if reported >= sum(manifest.values()) and bigquery_handler.create_gcs_marker(f"{prefix}/coordinator.marker"):
+        queue.publish({'mode': 'coordinate', 'run_id': run_id})
+        queue.flush()
+        logging.info(f"All {reported} shards of run {run_id} reported, triggered the coordinator.")
+
+def coordinate(work_item, bigquery_handler):
+    """Load the staged shards of every table into BigQuery with a single load job per table, then clean up the run."""
+    prefix = _run_prefix(work_item['run_id'])
+    manifest = bigquery_handler.read_json_from_gcs(f"{prefix}/manifest.json")
+    if manifest is None:
+        # Already cleaned up by an earlier delivery of this item, or never dispatched
+        logging.error(f"Ignoring coordinate item for run {work_item['run_id']} without a manifest.")
+        return
+
+    for table_name, _, _, _ in TABLES:
+        schema = bigquery_handler.read_json_from_gcs(f"{prefix}/schemas/{table_name}.json")
+        if not manifest.get(table_name) or schema is None:
+            logging.info(f"No {table_name} fetched.")
+            continue
+
+        schema = [bigquery.SchemaField.from_api_repr(field) for field in schema]
+        bigquery_handler.load_from_gcs_to_bigquery(table_name, f"{prefix}/shards/{table_name}/*.json", schema)
+
+    # Only once every table has loaded, a failed load keeps the run files for the redelivered item
+    bigquery_handler.delete_gcs_prefix(f"{prefix}/")
+
+def _work_item_error(work_item, mode):
+    """Describe what is wrong with a work or coordinate item, or return None when it is valid."""
+    missing = [key for key in REQUIRED_WORK_ITEM_KEYS[mode] if key not in work_item]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    if mode == 'work':
+        if work_item['table'] not in TABLES_BY_NAME:
+            return f"unknown table {work_item['table']!r}"
+        if not isinstance(work_item['shard'], int) or not isinstance(work_item['start_id'], int):
+            return "shard and start_id must be integers"
+        if work_item['end_id'] is not None and not isinstance(work_item['end_id'], int):
+            return "end_id must be an integer or null"
+    return None
+
+def handle_work_item(work_item, odoo_api, bigquery_handler, queue, shard_size):
+    """Route a work item to the dispatcher, a worker or the coordinator.
+
+    Undecodable items, unknown modes and malformed work or coordinate items are
+    acknowledged without action, so a stray message never starts a new run and is
+    not redelivered forever.
+    """
+    if work_item is None:
+        logging.warning("Ignoring undecodable work item.")
+        return
+
+    mode = work_item.get('mode', 'dispatch')
+    if mode not in ('dispatch', 'work', 'coordinate'):
+        logging.error(f"Ignoring work item with unknown mode {mode!r}: {json.dumps(work_item)}")
+        return
+
+    error = _work_item_error(work_item, mode) if mode != 'dispatch' else None
+    if error:
+        logging.error(f"Ignoring malformed {mode} item, {error}: {json.dumps(work_item)}")
+    elif mode == 'dispatch':
+        dispatch(odoo_api, bigquery_handler, queue, shard_size)
+    elif mode == 'work':
+        process_work_item(work_item, odoo_api, bigquery_handler, queue)
     else:
-        logging.info("No contacts fetched.")
+        coordinate(work_item, bigquery_handler)
+
+def main(cloud_event, abc):
+    # Load configuration
+    config = load_config()
+
+    # Initialize OdooAPI and BigQueryHandler
+    odoo_api = OdooAPI(config['odoo'])
+    bigquery_handler = BigQueryHandler(config['bigquery'])
+
+    # Without a fan-out topic the whole run happens in this instance
+    fanout = config.get('fanout')
+    if not fanout:
+        run_all(odoo_api, bigquery_handler, config['odoo'].get('incremental_lines', True))
+        return
+
+    queue = PubSubQueue(fanout.get('project_id', config['bigquery']['project_id']), fanout['topic'])
+    shard_size = fanout.get('shard_size', DEFAULT_SHARD_SIZE)
+    handle_work_item(decode_work_item(cloud_event), odoo_api, bigquery_handler, queue, shard_size)
+
+def run_locally():
+    """Run the dispatcher, every worker and the coordinator in this process through an in-process queue."""
+    config = load_config()
+    odoo_api = OdooAPI(config['odoo'])
+    bigquery_handler = BigQueryHandler(config['bigquery'])
+    shard_size = config.get('fanout', {}).get('shard_size', DEFAULT_SHARD_SIZE)
+
+    queue = InProcessQueue()
+    queue.publish({'mode': 'dispatch'})
+    queue.drain(lambda work_item: handle_work_item(work_item, odoo_api, bigquery_handler, queue, shard_size))
@@ -2,6 +2,10 @@ import requests
 import logging
 import json
 from utils import safe_get, format_timestamp
+from odoo_metadata import OdooMetadata, DEFAULT_METADATA_TTL
+
+# Maximum number of parent ids sent in a single "in" domain when fetching child lines.
+PARENT_ID_BATCH_SIZE = 200
 
 class OdooAPI:
     def __init__(self, config):
@@ -10,9 +14,18 @@ class OdooAPI:
         self.login = config['login']
         self.password = config['password']
         self.db_name = config['db_name']
-
-    def _make_request(self, model, fields):
-        """Private method to make the API request to Odoo."""
+        self.metadata = OdooMetadata(
+            self._make_request,
+            cache_key=f"{self.base_url}/{self.db_name}",
+            ttl=config.get('metadata_ttl', DEFAULT_METADATA_TTL),
+            skip_non_stored=config.get('skip_non_stored_fields', True)
+        )
+
+    def _make_request(self, model, fields, domain=None, raise_errors=False):
+        """Private method to make the API request to Odoo, optionally filtered by a search domain.
+
+        Failed requests are logged and return no records, unless ``raise_errors`` is set.
+        """
         url = (f"{self.base_url}/send_request?model={model}"
                f"&login={self.login}&password={self.password}&api-key={self.api_key}&db={self.db_name}"
                f"&Content-Type=application/json")
@@ -28,6 +41,8 @@ class OdooAPI:
         }
 
         payload = {"fields": fields}
+        if domain:
+            payload["domain"] = domain
         logging.info(f"Payload: {json.dumps(payload, indent=2)}")
 
         try:
@@ -37,9 +52,51 @@ class OdooAPI:
 
         except requests.exceptions.RequestException as e:
             logging.error(f"Error making request: {str(e)}")
+            if raise_errors:
+                raise
             return []
 
-    def fetch_sales_orders(self):
+    def _fetch_records(self, model, fields, domain=None, raise_errors=False):
+        """Request only the fields known to the model and fill the dropped ones with None."""
+        valid_fields = self.metadata.validate_fields(model, fields)
+        records = self._make_request(model, valid_fields, domain, raise_errors)
+
+        for record in records:
+            for field in fields:
+                record.setdefault(field, None)
+
+        return records
+
+    def fetch_ids(self, model):
+        """Fetch the sorted ids of every record of a model, raising if the request fails."""
+        records = self._make_request(model, ["id"], raise_errors=True)
+        return sorted(record['id'] for record in records)
+
+    def fetch_lines_for_parents(self, fetch_method, parent_field, parent_ids):
+        """Fetch only the lines of the given parents, batching the ids into bounded "in" domains.
+
+        Raises if any batch fails, since missing lines would otherwise be taken as deleted ones.
+        """
+        fetch_lines = getattr(self, fetch_method)
+        parent_column = f"{parent_field}_id"
+
+        records = []
+        for i in range(0, len(parent_ids), PARENT_ID_BATCH_SIZE):
+            batch = parent_ids[i:i + PARENT_ID_BATCH_SIZE]
+            batch_lines = fetch_lines(domain=[[parent_field, 'in', batch]], raise_errors=True)
+
+            # Filtered again here so an endpoint that ignores the domain cannot duplicate lines
+            batch_keys = {str(parent_id) for parent_id in batch}
+            matching_lines = [record for record in batch_lines if record[parent_column] in batch_keys]
+            if len(matching_lines) < len(batch_lines):
+                logging.warning(f"Dropped {len(batch_lines) - len(matching_lines)} lines outside the requested "
+                                f"{parent_field} batch returned by {fetch_method}.")
+            records.extend(matching_lines)
+
+        logging.info(f"Fetched {len(records)} lines of {len(parent_ids)} parents through {fetch_method}.")
+        return records
+
+    def fetch_sales_orders(self, domain=None, raise_errors=False):
         """Fetch Sales Orders from Odoo API."""
         fields = [
             "name", "date_order", "expected_date", "partner_id", "user_id", "team_id", 
@@ -47,7 +104,7 @@ class OdooAPI:
             "warehouse_id", "amount_to_invoice", "client_order_ref", "invoice_status", 
             "delivery_status", "state"
         ]
-        orders = self._make_request('sale.order', fields)
+        orders = self._fetch_records('sale.order', fields, domain, raise_errors)
         
         if not orders:
             logging.info("No sales orders found.")
@@ -81,14 +138,14 @@ class OdooAPI:
 
         
         """Fetch Sales Orders Lines from Odoo API."""
-    def fetch_sales_order_line(self):
+    def fetch_sales_order_line(self, domain=None, raise_errors=False):
         fields = [
             "product_id","product_template_id", "name", "stock_item_note", "warehouses_id", 
             "free_qty_today", "route_id", "product_uom_qty", "qty_delivered", "qty_invoiced", 
             "product_uom", "customer_lead", "product_packaging_qty", "product_packaging_id", 
-            "price_unit", "tax_id", "price_subtotal", "price_total"
+            "price_unit", "tax_id", "price_subtotal", "price_total", "order_id"
         ]
-        order_line = self._make_request('sale.order.line', fields)
+        order_line = self._fetch_records('sale.order.line', fields, domain, raise_errors)
         
         if not order_line:
             logging.info("No sales order line found.")
@@ -136,7 +193,11 @@ class OdooAPI:
                 'tax_id': str(record['tax_id'][0]) if isinstance(record['tax_id'], list) and len(record['tax_id']) > 0 else str(record['tax_id']) if not isinstance(record['tax_id'], list) else None,
 
                 'price_subtotal': str(safe_get(record, 'price_subtotal')),
-                'price_total': str(safe_get(record, 'price_total'))
+                'price_total': str(safe_get(record, 'price_total')),
+
+                # Safely handling list fields: order_id
+                'order_id_id': str(record['order_id'][0]) if isinstance(record['order_id'], list) and len(record['order_id']) > 0 else str(record['order_id']) if not isinstance(record['order_id'], list) else None,
+                'order_id_name': str(record['order_id'][1]) if isinstance(record['order_id'], list) and len(record['order_id']) > 1 else None
             }
 
             processed_records.append(processed_record)
@@ -144,15 +205,15 @@ class OdooAPI:
         return processed_records
 
     """Fetch Purchase Orders from Odoo API."""
-    def fetch_purchase_orders(self):
+    def fetch_purchase_orders(self, domain=None, raise_errors=False):
         fields = [
             "name", "partner_id", "partner_ref", "user_id", "date_order", "origin", 
             "amount_untaxed", "amount_total", "state", "invoice_status", 
             "write_date", "create_date"
         ]
         
-        # Fetch data from Odoo (assuming the _make_request method is available)
-        purchase_orders = self._make_request('purchase.order', fields)
+        # Fetch data from Odoo, skipping fields the model does not provide
+        purchase_orders = self._fetch_records('purchase.order', fields, domain, raise_errors)
 
         if not purchase_orders:
             logging.info("No purchase orders found.")
@@ -194,16 +255,16 @@ class OdooAPI:
         return processed_records
 
     """Fetch Purchase Order Lines from Odoo API."""
-    def fetch_purchase_order_line(self):
+    def fetch_purchase_order_line(self, domain=None, raise_errors=False):
         
         fields = [
             "name", "product_id", "date_planned", "product_qty", "qty_received", 
             "qty_invoiced", "product_uom", "product_packaging_qty", "product_packaging_id", 
-            "price_unit", "taxes_id", "discount", "price_subtotal", "price_total"
+            "price_unit", "taxes_id", "discount", "price_subtotal", "price_total", "order_id"
         ]
         
-        # Fetch data from Odoo (assuming the _make_request method is available)
-        purchase_order_line = self._make_request('purchase.order.line', fields)
+        # Fetch data from Odoo, skipping fields the model does not provide
+        purchase_order_line = self._fetch_records('purchase.order.line', fields, domain, raise_errors)
 
         if not purchase_order_line:
             logging.info("No purchase order lines found.")
@@ -214,13 +275,16 @@ class OdooAPI:
             processed_record = {
                 'id': str(safe_get(record, 'id')),
 
-                # Safely handling list fields: product_id and product_uom
+                # Safely handling list fields: product_id, product_uom and order_id
                 'product_id_id': str(record['product_id'][0]) if isinstance(record['product_id'], list) and len(record['product_id']) > 0 else str(record['product_id']) if not isinstance(record['product_id'], list) else None,
                 'product_id_name': str(record['product_id'][1]) if isinstance(record['product_id'], list) and len(record['product_id']) > 1 else None,
 
                 'product_uom_id': str(record['product_uom'][0]) if isinstance(record['product_uom'], list) and len(record['product_uom']) > 0 else str(record['product_uom']) if not isinstance(record['product_uom'], list) else None,
                 'product_uom_name': str(record['product_uom'][1]) if isinstance(record['product_uom'], list) and len(record['product_uom']) > 1 else None,
 
+                'order_id_id': str(record['order_id'][0]) if isinstance(record['order_id'], list) and len(record['order_id']) > 0 else str(record['order_id']) if not isinstance(record['order_id'], list) else None,
+                'order_id_name': str(record['order_id'][1]) if isinstance(record['order_id'], list) and len(record['order_id']) > 1 else None,
+
                 # Regular fields
                 'name': str(safe_get(record, 'name')),
                 'product_qty': str(safe_get(record, 'product_qty')),
@@ -249,7 +313,7 @@ class OdooAPI:
         return processed_records
 
 
-    def fetch_accounts(self):
+    def fetch_accounts(self, domain=None, raise_errors=False):
         """Fetch Accounts (account.move) from Odoo API."""
         fields = [
             "name", "date", "invoice_date", "delivery_date", "invoice_date_due", 
@@ -261,8 +325,8 @@ class OdooAPI:
             "ref", "to_check", "warehouse_id", "payment_reference"
         ]
         
-        # Fetch data from Odoo (assuming the _make_request method is available)
-        accounts = self._make_request('account.move', fields)
+        # Fetch data from Odoo, skipping fields the model does not provide
+        accounts = self._fetch_records('account.move', fields, domain, raise_errors)
 
         if not accounts:
             logging.info("No account moves found.")
@@ -323,7 +387,7 @@ class OdooAPI:
         return processed_records
     
     """Fetch Account Move Lines from Odoo API."""
-    def fetch_account_move_lines(self):
+    def fetch_account_move_lines(self, domain=None, raise_errors=False):
         
         fields = [
             "product_id", "product_template_id", "name", "stock_item_note", "price_unit", 
@@ -332,8 +396,8 @@ class OdooAPI:
             "rebate_perc", "after_rebate_price", "move_id"
         ]
         
-        # Fetch data from Odoo (assuming the _make_request method is available)
-        records = self._make_request('account.move.line', fields)
+        # Fetch data from Odoo, skipping fields the model does not provide
+        records = self._fetch_records('account.move.line', fields, domain, raise_errors)
 
         if not records:
             logging.info("No account move lines found.")
@@ -377,7 +441,7 @@ class OdooAPI:
         return processed_records
 
     """Fetch Stock Inventory (stock.picking) from Odoo API."""
-    def fetch_stock_inventory(self):
+    def fetch_stock_inventory(self, domain=None, raise_errors=False):
         
         fields = [
             "name", "location_id", "origin", "user_id", "partner_id", 
@@ -385,8 +449,8 @@ class OdooAPI:
             "write_date", "create_date", "product_id", "product_quantity"
         ]
         
-        # Fetch data from Odoo (assuming the _make_request method is available)
-        stock = self._make_request('stock.picking', fields)
+        # Fetch data from Odoo, skipping fields the model does not provide
+        stock = self._fetch_records('stock.picking', fields, domain, raise_errors)
 
         if not stock:
             logging.info("No stock pickings found.")
@@ -429,14 +493,14 @@ class OdooAPI:
         return processed_records
 
 
-    def fetch_contacts(self):
+    def fetch_contacts(self, domain=None, raise_errors=False):
         """Fetch Contacts (res.partner) from Odoo API."""
         fields = [
             "name", "cust_category_id", "contact_type", "stop_supply", "write_date", "create_date"
         ]
         
-        # Fetch data from Odoo (assuming the _make_request method is available)
-        contacts = self._make_request('res.partner', fields)
+        # Fetch data from Odoo, skipping fields the model does not provide
+        contacts = self._fetch_records('res.partner', fields, domain, raise_errors)
 
         if not contacts:
             logging.info("No contacts found.")
@@ -461,7 +525,7 @@ class OdooAPI:
         return processed_records
 
     """Fetch Manufacturing Orders (mrp.production) from Odoo API."""
-    def fetch_manufacturing(self):
+    def fetch_manufacturing(self, domain=None, raise_errors=False):
        
         fields = [
             "name", "date_start", "date_finished", "date_deadline", "product_id", 
@@ -470,11 +534,11 @@ class OdooAPI:
             "state", "write_date", "create_date"
         ]
         
-        # Fetch data from Odoo API using the class method _make_request
-        records = self._make_request('mrp.production', fields)
+        # Fetch data from Odoo, skipping fields the model does not provide
+        records = self._fetch_records('mrp.production', fields, domain, raise_errors)
 
         if not records:
-            logger.info("No manufacturing orders found.")
+            logging.info("No manufacturing orders found.")
             return []
 
         processed_records = []
@@ -0,0 +1,120 @@
+import logging
+import time
+from google.cloud import bigquery
+
+# Seconds before cached field definitions are fetched again from Odoo.
+DEFAULT_METADATA_TTL = 3600
+
+# Odoo field types that get a dedicated BigQuery column type, everything else stays STRING.
+ODOO_TO_BIGQUERY_TYPES = {
+    'integer': 'INTEGER',
+    'float': 'FLOAT',
+    'monetary': 'FLOAT',
+    'boolean': 'BOOLEAN',
+    'date': 'DATE',
+    'datetime': 'TIMESTAMP'
+}
+
+# Seconds before a model whose definitions could not be fetched is tried again.
+FAILED_METADATA_TTL = 300
+
+# Shared across instances so warm Cloud Function invocations reuse the definitions.
+# Keyed by (Odoo database, model).
+_metadata_cache = {}
+
+class OdooMetadata:
+    def __init__(self, request_fn, cache_key, ttl=DEFAULT_METADATA_TTL, skip_non_stored=True):
+        self.request_fn = request_fn  # Callable(model, fields, domain) returning Odoo records
+        self.cache_key = cache_key
+        self.ttl = ttl
+        self.skip_non_stored = skip_non_stored
+
+    def _load_definitions(self, models):
+        """Fetch field definitions of the given models from ir.model.fields."""
+        records = self.request_fn(
+            'ir.model.fields', ["name", "model", "ttype", "relation", "store"], [['model', 'in', models]]
+        )
+
+        definitions = {}
+        for record in records:
+            # Filtered again here in case the endpoint returns more models than asked for
+            if record['model'] not in models:
+                continue
+            definitions.setdefault(record['model'], {})[record['name']] = {
+                'type': record.get('ttype'),
+                'relation': record.get('relation') or None,
+                # Fields that are not stored are computed (or related) on every read
+                'store': bool(record.get('store'))
+            }
+
+        logging.info(f"Loaded field metadata for {len(definitions)} of {len(models)} Odoo models.")
+        return definitions
+
+    def load(self, models):
+        """Fetch the definitions of every given model whose cache entry is missing or expired, in one request."""
+        now = time.monotonic()
+        expired = []
+        for model in models:
+            cached = _metadata_cache.get((self.cache_key, model))
+            if (cached is None or cached['expires_at'] <= now) and model not in expired:
+                expired.append(model)
+        if not expired:
+            return
+
+        definitions = self._load_definitions(expired)
+        for model in expired:
+            key = (self.cache_key, model)
+            if definitions.get(model):
+                _metadata_cache[key] = {'expires_at': now + self.ttl, 'fields': definitions[model]}
+            else:
+                # Retry a failed fetch only after a short while, serving stale definitions meanwhile
+                previous = _metadata_cache.get(key)
+                _metadata_cache[key] = {
+                    'expires_at': now + FAILED_METADATA_TTL,
+                    'fields': previous['fields'] if previous else {}
+                }
+
+    def get_fields(self, model):
+        """Return the cached field definitions of a model, refreshing them once the TTL expires."""
+        self.load([model])
+        return _metadata_cache[(self.cache_key, model)]['fields']
+
+    def validate_fields(self, model, fields):
+        """Return the requested fields that exist on the model, dropping missing and non-stored ones."""
+        definitions = self.get_fields(model)
+        if not definitions:
+            logging.warning(f"No field metadata available for {model}, requesting all fields unchecked.")
+            return list(fields)
+
+        valid_fields = []
+        for field in fields:
+            definition = definitions.get(field)
+            if definition is None:
+                logging.warning(f"Field {field} does not exist on {model} and will be loaded as null.")
+            elif self.skip_non_stored and not definition['store']:
+                logging.info(f"Skipping non-stored computed field {field} on {model}.")
+            else:
+                valid_fields.append(field)
+
+        return valid_fields
+
+    def bigquery_schema(self, model, records, table_schema=None):
+        """Derive the BigQuery schema of processed records from the model's field types.
+
+        Columns the metadata cannot type keep their type from ``table_schema``, the
+        schema of the existing table, so a failed metadata fetch never downgrades them.
+        """
+        definitions = self.get_fields(model)
+        if not definitions and table_schema:
+            logging.warning(f"No field metadata available for {model}, keeping the existing column types.")
+        existing_types = {field.name: field.field_type for field in table_schema or []}
+
+        schema = []
+        for column in records[0].keys():
+            if column in definitions:
+                field_type = ODOO_TO_BIGQUERY_TYPES.get(definitions[column]['type'], "STRING")
+            else:
+                field_type = existing_types.get(column, "STRING")
+            schema.append(bigquery.SchemaField(column, field_type))
+
+        return schema
@@ -0,0 +1,208 @@
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pytest
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+import bigquery_handler
+from bigquery_handler import BigQueryHandler, STREAM_APPEND_ROWS
+
+SCHEMA = [bigquery.SchemaField("id", "INTEGER"), bigquery.SchemaField("name", "STRING")]
+
+
+class FakeFuture:
+    def result(self):
+        return None
+
+
+class FakeWriteClient:
+    """Local stand-in for BigQueryWriteClient that records every call in order."""
+
+    def __init__(self, events):
+        self.events = events
+        self.stream_errors = []
+
+    def table_path(self, project, dataset, table):
+        return f"projects/{project}/datasets/{dataset}/tables/{table}"
+
+    def create_write_stream(self, parent, write_stream):
+        self.events.append(("create_write_stream", parent, write_stream.type_))
+        return SimpleNamespace(name=f"{parent}/streams/pending")
+
+    def finalize_write_stream(self, name):
+        self.events.append(("finalize", name))
+
+    def batch_commit_write_streams(self, request):
+        self.events.append(("commit", request.parent, list(request.write_streams)))
+        return SimpleNamespace(stream_errors=self.stream_errors)
+
+
+class FakeAppendRowsStream:
+    """Local stand-in for AppendRowsStream that keeps the Arrow payloads it is sent."""
+
+    def __init__(self, client, template):
+        self.events = client.events
+        self.events.append(("open_append", template.write_stream))
+        self.arrow_schema = pa.ipc.read_schema(pa.py_buffer(template.arrow_rows.writer_schema.serialized_schema))
+        client.append_stream = self
+        self.batches = []
+
+    def send(self, request):
+        batch = pa.ipc.read_record_batch(
+            pa.py_buffer(request.arrow_rows.rows.serialized_record_batch), self.arrow_schema
+        )
+        self.batches.append((request.offset, batch))
+        self.events.append(("append", request.offset, batch.num_rows))
+        return FakeFuture()
+
+    def close(self):
+        self.events.append(("close_append",))
+
+
+class FakeBigQueryClient:
+    def __init__(self, events, project):
+        self.events = events
+        self.project = project
+        self.tables = {}
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def get_table(self, table_ref):
+        if table_ref.table_id not in self.tables:
+            raise NotFound(table_ref.table_id)
+        return self.tables[table_ref.table_id]
+
+    def create_table(self, table, exists_ok=False):
+        self.events.append(("create_table", table.table_id))
+        self.tables.setdefault(table.table_id, table)
+
+    def delete_table(self, table_ref, not_found_ok=False):
+        self.events.append(("delete_table", table_ref.table_id))
+        self.tables.pop(table_ref.table_id, None)
+
+    def query(self, query, job_config=None):
+        self.events.append(("query", query, job_config))
+        return SimpleNamespace(result=lambda: [])
+
+
+@pytest.fixture
+def events():
+    return []
+
+
+@pytest.fixture
+def handler(monkeypatch, events):
+    monkeypatch.setattr(bigquery_handler.bigquery, "Client", lambda project: FakeBigQueryClient(events, project))
+    monkeypatch.setattr(bigquery_handler.storage, "Client", lambda: None)
+    monkeypatch.setattr(bigquery_handler.bigquery_storage_v1, "BigQueryWriteClient", lambda: FakeWriteClient(events))
+    monkeypatch.setattr(bigquery_handler.writer, "AppendRowsStream", FakeAppendRowsStream)
+    return BigQueryHandler({
+        'project_id': 'proj', 'dataset_id': 'ds', 'bucket_name': 'bucket', 'stream_max_rows': 1500
+    })
+
+
+def _rows(count):
+    return [{'id': i, 'name': f"record {i}"} for i in range(count)]
+
+
+def _event_names(events):
+    return [event[0] for event in events]
+
+
+def test_stream_appends_arrow_batches_at_row_offsets(handler):
+    handler.stream_to_bigquery('orders', _rows(1200), SCHEMA)
+
+    batches = handler.write_client.append_stream.batches
+    assert [offset for offset, _ in batches] == [0, STREAM_APPEND_ROWS, 2 * STREAM_APPEND_ROWS]
+    assert [batch.num_rows for _, batch in batches] == [500, 500, 200]
+    assert batches[0][1].schema.field('id').type == pa.int64()
+    assert batches[2][1].to_pylist()[-1] == {'id': 1199, 'name': "record 1199"}
+
+
+def test_stream_commits_staging_before_one_transaction_swap(handler, events):
+    handler.stream_to_bigquery('orders', _rows(3), SCHEMA)
+
+    names = _event_names(events)
+    assert names == [
+        'create_table', 'create_table', 'create_write_stream', 'open_append', 'append',
+        'close_append', 'finalize', 'commit', 'query', 'delete_table'
+    ]
+
+    staging_name = events[1][1]
+    assert staging_name.startswith('orders_staging_')
+    assert events[2][1].endswith(f"/tables/{staging_name}")
+    assert events[2][2] == bigquery_handler.types.WriteStream.Type.PENDING
+
+    query = events[8][1]
+    assert query.startswith("BEGIN TRANSACTION;")
+    assert "DELETE FROM `proj.ds.orders` WHERE TRUE;" in query
+    assert f"INSERT INTO `proj.ds.orders` (id, name) SELECT id, name FROM `proj.ds.{staging_name}`;" in query
+    assert query.endswith("COMMIT TRANSACTION;")
+    assert events[9][1] == staging_name
+
+
+def test_stream_replacement_deletes_only_replaced_keys(handler, events):
+    handler.stream_to_bigquery('orders', _rows(2), SCHEMA, replace_column='order_id_id', replace_values=['7', '9'])
+
+    _, query, job_config = next(event for event in events if event[0] == 'query')
+    assert "DELETE FROM `proj.ds.orders` WHERE order_id_id IN UNNEST(@keys);" in query
+    assert job_config.query_parameters[0].values == ['7', '9']
+
+
+def test_commit_stream_errors_raise_and_leave_target_untouched(handler, events):
+    handler.write_client.stream_errors = ["row 2 is invalid"]
+
+    with pytest.raises(RuntimeError, match="row 2 is invalid"):
+        handler.stream_to_bigquery('orders', _rows(3), SCHEMA)
+
+    names = _event_names(events)
+    assert 'query' not in names
+    assert names[-2:] == ['commit', 'delete_table']
+
+
+def test_insert_streams_batches_up_to_stream_max_rows(handler, monkeypatch):
+    calls = []
+    monkeypatch.setattr(handler, "stream_to_bigquery", lambda table, data, schema: calls.append(('stream', len(data))))
+    monkeypatch.setattr(handler, "upload_to_gcs", lambda data, path, chunk_size: calls.append(('gcs', len(data))))
+    monkeypatch.setattr(handler, "load_from_gcs_to_bigquery", lambda table, path, schema: calls.append(('load', table)))
+
+    handler.insert_into_bigquery_in_batches('orders', _rows(1500), 100, SCHEMA)
+    handler.insert_into_bigquery_in_batches('orders', _rows(1501), 100, SCHEMA)
+
+    assert calls == [('stream', 1500), ('gcs', 1501), ('load', 'orders')]
+
+
+def test_insert_uses_load_job_when_table_schema_changed(handler, monkeypatch):
+    handler.client.tables['orders'] = bigquery.Table(
+        "proj.ds.orders", schema=[bigquery.SchemaField("id", "STRING"), bigquery.SchemaField("name", "STRING")]
+    )
+    calls = []
+    monkeypatch.setattr(handler, "stream_to_bigquery", lambda table, data, schema: calls.append('stream'))
+    monkeypatch.setattr(handler, "upload_to_gcs", lambda data, path, chunk_size: calls.append('gcs'))
+    monkeypatch.setattr(handler, "load_from_gcs_to_bigquery", lambda table, path, schema: calls.append('load'))
+
+    handler.insert_into_bigquery_in_batches('orders', [{'id': '1', 'name': 'a'}], 100, SCHEMA)
+
+    assert calls == ['gcs', 'load']
+
+
+def test_delete_gcs_prefix_deletes_every_file_under_the_prefix(handler):
+    deleted = []
+    blobs = ["temp/runs/run-1/manifest.json", "temp/runs/run-1/shards/contacts/00000.json"]
+    handler.storage_client = SimpleNamespace(
+        list_blobs=lambda bucket, prefix: [blob for blob in blobs if blob.startswith(prefix)],
+        bucket=lambda name: SimpleNamespace(delete_blobs=deleted.extend)
+    )
+
+    handler.delete_gcs_prefix("temp/runs/run-1/")
+
+    assert deleted == blobs
+
+
+def test_unparsable_values_are_logged_with_their_column(handler, caplog):
+    records = handler._coerce_records([{'id': '1O', 'name': 'a'}], SCHEMA)
+
+    assert records == [{'id': None, 'name': 'a'}]
+    assert "Could not parse '1O' in column id as INTEGER" in caplog.text
@@ -0,0 +1,310 @@
+import base64
+import json
+from types import SimpleNamespace
+
+import pytest
+import requests
+from google.cloud import bigquery
+
+import main
+import odoo_api
+import odoo_metadata
+from odoo_api import OdooAPI
+from utils import decode_work_item
+from work_queue import InProcessQueue
+
+ODOO_CONFIG = {'base_url': 'https://odoo', 'api_key': 'key', 'login': 'login', 'password': 'pw', 'db_name': 'db'}
+
+
+@pytest.fixture(autouse=True)
+def empty_metadata_cache(monkeypatch):
+    monkeypatch.setattr(odoo_metadata, "_metadata_cache", {})
+
+
+class FakeResponse:
+    def __init__(self, records):
+        self.records = records
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'records': self.records}
+
+
+class FakeOdooServer:
+    """Answers send_request calls from canned records, or fails requests for the given models."""
+
+    def __init__(self, records, failing_models=()):
+        self.records = records
+        self.failing_models = failing_models
+        self.requests = []
+
+    def get(self, url, headers, data, timeout):
+        model = url.split("model=")[1].split("&")[0]
+        payload = json.loads(data)
+        self.requests.append((model, payload.get('domain')))
+        if model in self.failing_models:
+            raise requests.exceptions.Timeout(f"{model} timed out")
+        return FakeResponse([dict(record) for record in self.records.get(model, [])])
+
+
+class FakeBigQueryHandler:
+    """Keeps GCS files in a dict and records staged shards and load jobs."""
+
+    def __init__(self, manifest=None):
+        self.files = {}
+        if manifest is not None:
+            self.files['temp/runs/run-1/manifest.json'] = manifest
+        self.staged = []
+        self.loads = []
+        self.deleted = {}
+
+    def get_table_schema(self, table_name):
+        return None
+
+    def stage_shard(self, gcs_path, data, chunk_size, schema):
+        self.staged.append((gcs_path, len(data)))
+        self.files[gcs_path] = data
+
+    def write_json_to_gcs(self, gcs_path, payload):
+        self.files[gcs_path] = payload
+
+    def read_json_from_gcs(self, gcs_path):
+        return self.files.get(gcs_path)
+
+    def count_gcs_files(self, prefix):
+        return sum(1 for path in self.files if path.startswith(prefix))
+
+    def create_gcs_marker(self, gcs_path):
+        if gcs_path in self.files:
+            return False
+        self.files[gcs_path] = ""
+        return True
+
+    def load_from_gcs_to_bigquery(self, table_name, gcs_path, schema):
+        self.loads.append((table_name, gcs_path, [(field.name, field.field_type) for field in schema]))
+
+    def delete_gcs_prefix(self, prefix):
+        for path in [path for path in self.files if path.startswith(prefix)]:
+            self.deleted[path] = self.files.pop(path)
+
+
+def _odoo(monkeypatch, server):
+    monkeypatch.setattr(odoo_api.requests, "get", server.get)
+    return OdooAPI(ODOO_CONFIG)
+
+
+def _work_item(shard=0, start_id=1, end_id=None):
+    return {'mode': 'work', 'run_id': 'run-1', 'table': 'contacts', 'shard': shard, 'start_id': start_id, 'end_id': end_id}
+
+
+def test_worker_raises_on_failed_fetch_without_staging_a_shard(monkeypatch):
+    odoo = _odoo(monkeypatch, FakeOdooServer({}, failing_models=['res.partner']))
+    handler = FakeBigQueryHandler({'contacts': 1})
+
+    with pytest.raises(requests.exceptions.Timeout):
+        main.process_work_item(_work_item(), odoo, handler, InProcessQueue())
+
+    assert handler.staged == []
+
+
+def test_worker_stages_empty_range_and_triggers_coordinator(monkeypatch):
+    odoo = _odoo(monkeypatch, FakeOdooServer({}))
+    handler = FakeBigQueryHandler({'contacts': 1})
+    queue = InProcessQueue()
+
+    main.process_work_item(_work_item(start_id=10, end_id=20), odoo, handler, queue)
+
+    assert handler.staged == [('temp/runs/run-1/shards/contacts/00000.json', 0)]
+    assert list(queue.items) == [{'mode': 'coordinate', 'run_id': 'run-1'}]
+
+
+def test_worker_fetches_only_its_id_range(monkeypatch):
+    server = FakeOdooServer({'res.partner': [{'id': 12, 'name': 'Azure'}]})
+    odoo = _odoo(monkeypatch, server)
+    handler = FakeBigQueryHandler({'contacts': 2})
+    queue = InProcessQueue()
+
+    main.process_work_item(_work_item(shard=1, start_id=10, end_id=20), odoo, handler, queue)
+
+    assert ('res.partner', [['id', '>=', 10], ['id', '<=', 20]]) in server.requests
+    assert handler.staged == [('temp/runs/run-1/shards/contacts/00001.json', 1)]
+    # The other shard has not reported yet
+    assert list(queue.items) == []
+
+
+def _cloud_event(data):
+    return SimpleNamespace(data={'message': {'data': base64.b64encode(data).decode() if data else data}})
+
+
+@pytest.mark.parametrize("cloud_event", [
+    _cloud_event(None),
+    _cloud_event(b""),
+    _cloud_event(b"{}"),
+    _cloud_event(b'{"mode": "dispatch"}'),
+    SimpleNamespace(data={})
+])
+def test_scheduler_trigger_dispatches(cloud_event, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "dispatch", lambda *args: calls.append('dispatch'))
+
+    main.handle_work_item(decode_work_item(cloud_event), None, None, InProcessQueue(), 10)
+
+    assert calls == ['dispatch']
+
+
+@pytest.mark.parametrize("data", [b"run now", b"[1, 2]", b"\xff\xfe", b'{"mode": "restart"}'])
+def test_junk_messages_are_ignored(data, monkeypatch):
+    calls = []
+    for name in ("dispatch", "process_work_item", "coordinate"):
+        monkeypatch.setattr(main, name, lambda *args, name=name: calls.append(name))
+
+    main.handle_work_item(decode_work_item(_cloud_event(data)), None, None, InProcessQueue(), 10)
+
+    assert calls == []
+
+
+@pytest.mark.parametrize("work_item", [
+    {'mode': 'work'},
+    {'mode': 'work', 'run_id': 'run-1', 'table': 'contacts', 'shard': 0, 'start_id': 1},
+    dict(_work_item(), table='invoices'),
+    dict(_work_item(), start_id="1"),
+    dict(_work_item(), end_id=[20]),
+    {'mode': 'coordinate'}
+])
+def test_malformed_work_items_are_ignored(work_item, monkeypatch):
+    calls = []
+    for name in ("dispatch", "process_work_item", "coordinate"):
+        monkeypatch.setattr(main, name, lambda *args, name=name: calls.append(name))
+
+    main.handle_work_item(work_item, None, None, InProcessQueue(), 10)
+
+    assert calls == []
+
+
+def test_coordinate_without_manifest_loads_nothing():
+    handler = FakeBigQueryHandler()
+
+    main.handle_work_item({'mode': 'coordinate', 'run_id': 'run-1'}, None, handler, InProcessQueue(), 10)
+
+    assert handler.loads == []
+
+
+class FakeLineTableHandler:
+    """Header and line tables that already hold a previous run."""
+
+    def __init__(self):
+        self.calls = []
+
+    def fetch_max_value(self, table_name, column):
+        return "2024-01-03T00:00:00.000000Z"
+
+    def get_table_schema(self, table_name):
+        return [bigquery.SchemaField('id', 'STRING'), bigquery.SchemaField('order_id_id', 'STRING')]
+
+    def table_schema_matches(self, table_name, schema):
+        return True
+
+    def replace_rows(self, table_name, key_column, key_values, data, chunk_size, schema):
+        self.calls.append(('replace', table_name, key_values, sorted(record['id'] for record in data)))
+
+    def insert_into_bigquery_in_batches(self, table_name, data, chunk_size, schema):
+        self.calls.append(('load', table_name, len(data)))
+
+
+SALE_ORDERS = [{'id': i, 'write_date': f"2024-01-0{i} 00:00:00"} for i in range(1, 6)]
+SALE_ORDER_LINES = [{'id': 10 + i, 'order_id': [i, f"S0000{i}"]} for i in range(1, 6)]
+
+
+def test_line_refresh_replaces_only_lines_of_changed_parents(monkeypatch):
+    server = FakeOdooServer({'sale.order': SALE_ORDERS, 'sale.order.line': SALE_ORDER_LINES[2:]})
+    handler = FakeLineTableHandler()
+
+    main.load_table_with_lines(_odoo(monkeypatch, server), handler, 'sales_orders')
+
+    assert ('sale.order.line', [['order_id', 'in', [3, 4, 5]]]) in server.requests
+    assert handler.calls == [
+        ('replace', 'sales_order_line', ['3', '4', '5'], ['13', '14', '15']),
+        ('load', 'sales_orders', 5)
+    ]
+
+
+def test_failed_line_fetch_skips_replace_and_header_load(monkeypatch):
+    server = FakeOdooServer({'sale.order': SALE_ORDERS}, failing_models=['sale.order.line'])
+    handler = FakeLineTableHandler()
+
+    with pytest.raises(requests.exceptions.Timeout):
+        main.load_table_with_lines(_odoo(monkeypatch, server), handler, 'sales_orders')
+
+    assert handler.calls == []
+
+
+def test_disabled_incremental_lines_reloads_every_line(monkeypatch):
+    server = FakeOdooServer({'sale.order': SALE_ORDERS, 'sale.order.line': SALE_ORDER_LINES})
+    handler = FakeLineTableHandler()
+
+    main.load_table_with_lines(_odoo(monkeypatch, server), handler, 'sales_orders', incremental_lines=False)
+
+    assert ('sale.order.line', None) in server.requests
+    assert handler.calls == [('load', 'sales_order_line', 5), ('load', 'sales_orders', 5)]
+
+
+def test_line_refresh_filters_lines_when_endpoint_ignores_domain(monkeypatch):
+    # The fake server ignores the domain and returns every line on each request
+    server = FakeOdooServer({'sale.order': SALE_ORDERS, 'sale.order.line': SALE_ORDER_LINES})
+    monkeypatch.setattr(odoo_api, "PARENT_ID_BATCH_SIZE", 2)
+    handler = FakeLineTableHandler()
+
+    main.load_table_with_lines(_odoo(monkeypatch, server), handler, 'sales_orders')
+
+    assert handler.calls[0] == ('replace', 'sales_order_line', ['3', '4', '5'], ['13', '14', '15'])
+
+
+def test_worker_filters_records_when_endpoint_ignores_domain(monkeypatch):
+    # The fake server ignores the domain and returns every contact
+    server = FakeOdooServer({'res.partner': [{'id': i, 'name': f"Contact {i}"} for i in (5, 10, 15, 20, 25)]})
+    handler = FakeBigQueryHandler({'contacts': 3})
+
+    main.process_work_item(_work_item(shard=1, start_id=10, end_id=20), _odoo(monkeypatch, server), handler, InProcessQueue())
+    main.process_work_item(_work_item(shard=2, start_id=21), _odoo(monkeypatch, server), handler, InProcessQueue())
+
+    assert [record['id'] for record in handler.files['temp/runs/run-1/shards/contacts/00001.json']] == ['10', '15', '20']
+    assert [record['id'] for record in handler.files['temp/runs/run-1/shards/contacts/00002.json']] == ['25']
+
+
+def test_in_process_run_shards_stages_and_loads_each_table_once(monkeypatch):
+    server = FakeOdooServer({
+        'res.partner': [{'id': i, 'name': f"Contact {i}"} for i in (3, 5, 8, 13, 21)],
+        'mrp.production': [{'id': 4, 'name': 'MO/00004'}]
+    })
+    odoo = _odoo(monkeypatch, server)
+    handler = FakeBigQueryHandler()
+    queue = InProcessQueue()
+    handled = []
+
+    def handle(work_item):
+        handled.append(work_item)
+        main.handle_work_item(work_item, odoo, handler, queue, 2)
+
+    queue.publish({'mode': 'dispatch'})
+    queue.drain(handle)
+
+    run_id = handled[1]['run_id']
+    prefix = f"temp/runs/{run_id}"
+    shards = [(item['table'], item['shard'], item['start_id'], item['end_id']) for item in handled if item['mode'] == 'work']
+    assert shards == [
+        ('contacts', 0, 3, 5), ('contacts', 1, 8, 13), ('contacts', 2, 21, None), ('manufacturing', 0, 4, None)
+    ]
+    assert [item for item in handled if item['mode'] == 'coordinate'] == [{'mode': 'coordinate', 'run_id': run_id}]
+
+    assert [(table, path) for table, path, _ in handler.loads] == [
+        ('contacts', f"{prefix}/shards/contacts/*.json"), ('manufacturing', f"{prefix}/shards/manufacturing/*.json")
+    ]
+    # Each load uses the schema its workers stored with the shards
+    for table_name, _, schema in handler.loads:
+        stored = handler.deleted[f"{prefix}/schemas/{table_name}.json"]
+        assert schema == [(field['name'], field['type']) for field in stored]
+    # The run's files are gone once the coordinator has loaded every table
+    assert handler.files == {}
+    assert f"{prefix}/shards/contacts/00002.json" in handler.deleted
@@ -0,0 +1,100 @@
+import pytest
+from google.cloud import bigquery
+
+import odoo_metadata
+from odoo_metadata import OdooMetadata
+
+FIELDS = [
+    {'model': 'sale.order', 'name': 'id', 'ttype': 'integer', 'relation': False, 'store': True},
+    {'model': 'sale.order', 'name': 'amount_total', 'ttype': 'monetary', 'relation': False, 'store': True},
+    {'model': 'sale.order', 'name': 'partner_id', 'ttype': 'many2one', 'relation': 'res.partner', 'store': True},
+    {'model': 'sale.order', 'name': 'amount_to_invoice', 'ttype': 'monetary', 'relation': False, 'store': False}
+]
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(odoo_metadata, "_metadata_cache", {})
+
+
+class FakeOdoo:
+    def __init__(self, records):
+        self.records = records
+        self.calls = []
+
+    def request(self, model, fields, domain=None):
+        self.calls.append((model, domain))
+        return self.records
+
+
+def _types(schema):
+    return [(field.name, field.field_type) for field in schema]
+
+
+def test_validate_fields_drops_missing_and_non_stored_fields():
+    metadata = OdooMetadata(FakeOdoo(FIELDS).request, 'odoo')
+
+    fields = metadata.validate_fields('sale.order', ['amount_total', 'rrp_price', 'amount_to_invoice'])
+
+    assert fields == ['amount_total']
+
+
+def test_schema_is_derived_from_field_types():
+    metadata = OdooMetadata(FakeOdoo(FIELDS).request, 'odoo')
+    records = [{'id': '1', 'amount_total': '5.0', 'partner_id': 'Azure', 'partner_id_name': 'Azure'}]
+
+    schema = metadata.bigquery_schema('sale.order', records)
+
+    assert _types(schema) == [
+        ('id', 'INTEGER'), ('amount_total', 'FLOAT'), ('partner_id', 'STRING'), ('partner_id_name', 'STRING')
+    ]
+
+
+def test_schema_keeps_existing_types_without_metadata():
+    metadata = OdooMetadata(FakeOdoo([]).request, 'odoo')
+    table_schema = [bigquery.SchemaField('id', 'INTEGER'), bigquery.SchemaField('amount_total', 'FLOAT')]
+    records = [{'id': '1', 'amount_total': '5.0', 'order_id_id': '3'}]
+
+    schema = metadata.bigquery_schema('sale.order', records, table_schema)
+
+    assert _types(schema) == [('id', 'INTEGER'), ('amount_total', 'FLOAT'), ('order_id_id', 'STRING')]
+
+
+def test_load_requests_only_the_given_models_once():
+    odoo = FakeOdoo(FIELDS + [{'model': 'res.partner', 'name': 'name', 'ttype': 'char', 'store': True}])
+    metadata = OdooMetadata(odoo.request, 'odoo')
+
+    metadata.load(['sale.order', 'res.partner'])
+    metadata.get_fields('sale.order')
+    metadata.get_fields('res.partner')
+
+    assert odoo.calls == [('ir.model.fields', [['model', 'in', ['sale.order', 'res.partner']]])]
+
+
+def test_failed_fetch_is_not_retried_until_it_expires(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(odoo_metadata.time, "monotonic", lambda: clock[0])
+    odoo = FakeOdoo([])
+    metadata = OdooMetadata(odoo.request, 'odoo')
+
+    for _ in range(5):
+        assert metadata.get_fields('sale.order') == {}
+    assert len(odoo.calls) == 1
+
+    clock[0] += odoo_metadata.FAILED_METADATA_TTL
+    metadata.get_fields('sale.order')
+    assert len(odoo.calls) == 2
+
+
+def test_failed_refresh_keeps_serving_stale_definitions(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(odoo_metadata.time, "monotonic", lambda: clock[0])
+    odoo = FakeOdoo(FIELDS)
+    metadata = OdooMetadata(odoo.request, 'odoo', ttl=60)
+    metadata.get_fields('sale.order')
+
+    odoo.records = []
+    clock[0] += 60
+
+    assert 'amount_total' in metadata.get_fields('sale.order')
+    assert len(odoo.calls) == 2
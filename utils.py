@@ -1,6 +1,7 @@
+import base64
 import json
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 
 def load_config():
     """Load configuration from config.json."""
@@ -11,6 +12,29 @@ def load_config():
         logging.error("Configuration file not found.")
         raise
 
+def decode_work_item(cloud_event):
+    """Decode the JSON work item carried by a Pub/Sub CloudEvent.
+
+    An absent or empty payload (the scheduler trigger) gives an empty work item,
+    a payload that is not a JSON object gives None.
+    """
+    try:
+        data = cloud_event.data["message"]["data"]
+    except (AttributeError, KeyError, TypeError):
+        return {}
+
+    if not data:
+        return {}
+    try:
+        work_item = json.loads(base64.b64decode(data))
+    except ValueError:
+        work_item = None
+
+    if not isinstance(work_item, dict):
+        logging.warning("Pub/Sub message is not a JSON work item.")
+        return None
+    return work_item
+
 def format_timestamp(timestamp):
     """Format timestamps to BigQuery-compatible format."""
     if not timestamp or isinstance(timestamp, bool):
@@ -34,3 +58,38 @@ def safe_get(data, field):
     """Helper function to safely get field values."""
     return data[field] if field in data and data[field] is not None else None
 
+
+
+def coerce_value(value, field_type, column=None):
+    """Convert a processed (stringified) Odoo value to the Python type of its BigQuery column.
+
+    A value that does not parse is loaded as null and logged, naming ``column`` when given.
+    """
+    if value is None or field_type == 'STRING':
+        return value
+
+    text = str(value)
+    if field_type == 'BOOLEAN':
+        return {'True': True, 'False': False}.get(text)
+    # Odoo returns False for empty non-boolean fields
+    if text in ('None', 'False', ''):
+        return None
+
+    try:
+        if field_type == 'INTEGER':
+            return int(text)
+        if field_type == 'FLOAT':
+            return float(text)
+        if field_type == 'DATE':
+            return datetime.strptime(text[:10], '%Y-%m-%d').date()
+        if field_type == 'TIMESTAMP':
+            try:
+                dt = datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%fZ')
+            except ValueError:
+                dt = datetime.strptime(text[:10], '%Y-%m-%d')
+            return dt.replace(tzinfo=timezone.utc)
+    except ValueError:
+        location = f" in column {column}" if column else ""
+        logging.warning(f"Could not parse {value!r}{location} as {field_type}, loading it as null.")
+        return None
+    return value
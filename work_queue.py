@@ -0,0 +1,41 @@
+import json
+import logging
+from collections import deque
+from google.cloud import pubsub_v1
+
+class PubSubQueue:
+    def __init__(self, project_id, topic):
+        self.publisher = pubsub_v1.PublisherClient()
+        self.topic_path = self.publisher.topic_path(project_id, topic)
+        self.futures = []
+
+    def publish(self, work_item):
+        """Publish a work item as a JSON message; call flush() to wait for delivery."""
+        self.futures.append(self.publisher.publish(self.topic_path, json.dumps(work_item).encode("utf-8")))
+
+    def flush(self):
+        """Wait until every published work item has been accepted by Pub/Sub."""
+        try:
+            for future in self.futures:
+                future.result()
+            logging.info(f"Published {len(self.futures)} work items to {self.topic_path}.")
+        finally:
+            self.futures = []
+
+class InProcessQueue:
+    """Local stand-in for PubSubQueue that runs every work item in the current process."""
+
+    def __init__(self):
+        self.items = deque()
+
+    def publish(self, work_item):
+        # Round-trip through JSON so items look exactly like decoded Pub/Sub messages
+        self.items.append(json.loads(json.dumps(work_item)))
+
+    def flush(self):
+        pass
+
+    def drain(self, handler):
+        """Hand queued work items to the handler until the queue is empty, including items it publishes."""
+        while self.items:
+            handler(self.items.popleft())